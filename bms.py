@@ -5,14 +5,33 @@
 import sys
 import argparse
 import re
-from functools import reduce
-from itertools import groupby
+import heapq
+
+# numpy module, imported on first exact decoding of large trellis (see `loadTrellisKernel`)
+np = None
 
 # path tuple indexes
-STATE = 2
-ERR_C = 1
+STATE = 3
+ERR_C = 2
+PATH_LEN = 1
 PATH = 0
 
+# error of unreachable trellis state
+ERR_INF = 2**30
+
+# minimal trellis size (input pairs * 2^X states) for compiled/vectorized trellis traversal
+#   - pure Python traversal takes ~0.8us per state and step, importing numba ~0.5s (measured break-even)
+TRELLIS_MIN_CELLS = 640000
+
+# bits of every byte value from LSB to MSB
+BYTE_BITS = [bytes((byte >> i) & 1 for i in range(8)) for byte in range(256)]
+
+# filters of not allowed characters on input
+ENCODE_FILTER = re.compile(rb"[^0-9A-Za-z]+")
+DECODE_DELETE = bytes(byte for byte in range(256) if byte not in b'01')
+# filter of non-ASCII characters on decoder output
+NON_ASCII_DELETE = bytes(range(128, 256))
+
 def main():
     """ 
         Main function. Parses command line arguments, calls appropriate functions and prints results to stdout.
@@ -23,31 +42,38 @@ def main():
     group.add_argument('-e', action='store_true', help='encoding mode (input: stdin)')
     group.add_argument('-d', action='store_true', help='decoding mode (input: stdin)')
     parser.add_argument('-p', '--params', nargs=3, metavar=('X', 'Y', 'Z'), type=int, help="X - number of delay cells\nY - upper feedback scheme\nZ - lower feedback scheme")
+    parser.add_argument('-b', '--beam', metavar='K', type=int, default=0, help="decoding - keep only K paths with the lowest error in each step\n(0 - disabled, default)")
+    parser.add_argument('-l', '--leniency', metavar='T', type=int, help="decoding - drop paths with error higher than lowest error + T in each step")
     args = parser.parse_args()
 
+    # read whole stdin at once
+    data = sys.stdin.buffer.read()
+    res = ''
+
     # filter not allowed characters from stdin and start encoding/decoding
     if args.e:
-        input = re.sub(r"[^0-9A-Za-z]*", '', ''.join(sys.stdin))
-        if not input:
-            print('')
-            return
-        if args.params != None:
-            if not all(p > 0 for p in args.params):
-                parser.error("params must be higher than 0.")
-            print(''.join(encode(input, args.params)))
-        else:
-            print(''.join(encode(input)))
+        input = ENCODE_FILTER.sub(b'', data).decode('ascii')
+        if input:
+            if args.params != None:
+                if not all(p > 0 for p in args.params):
+                    parser.error("params must be higher than 0.")
+                res = encode(input, args.params)
+            else:
+                res = encode(input)
     elif args.d:
-        input = re.sub(r"[^0-1]*", '', ''.join(sys.stdin))
-        if not input:
-            print('')
-            return
-        if args.params != None:
-            if not all(p > 0 for p in args.params):
-                parser.error("params must be higher than 0.")
-            print(''.join(decode(input, args.params)))
-        else:
-            print(''.join(decode(input)))
+        input = data.translate(None, DECODE_DELETE).decode('ascii')
+        if input:
+            if args.beam < 0 or (args.leniency != None and args.leniency < 0):
+                parser.error("beam and leniency must not be lower than 0.")
+            if args.params != None:
+                if not all(p > 0 for p in args.params):
+                    parser.error("params must be higher than 0.")
+                res = decode(input, args.params, args.beam, args.leniency)
+            else:
+                res = decode(input, beam=args.beam, leniency=args.leniency)
+
+    # write result to stdout at once
+    sys.stdout.buffer.write(res.encode('ascii') + b'\n')
 
 
 def encode(input_str, config=[5,53,46]):
@@ -69,32 +95,40 @@ def encode(input_str, config=[5,53,46]):
         
         Returns
         ----------
-        Encoded input in form of list of ones and zeroes as chars
+        Encoded input in form of string of ones and zeroes
 
         * - ones define connection of specific index
     """
     
-    # result list buffer initialization
-    res = []
-    # initialize state with given X value from config
-    state = [0 for x in range(config[0])]
-    # make list of parsed input characters in corresponding 8-bit representation 
-    input_bin = state + list(map(int, ''.join(('00000000' + bin(ord(c))).replace('b','')[-8:] for c in input_str)))
-    # get scheme indexes from config
-    indexes_y, indexes_z = getIndexes(config)
+    # initialize state with given X value from config (bitmask of X delay cells, newest cell is MSB)
+    state = 0
+    # input bits from the back (LSB of last char first) followed by X zero bits initializing the encoder
+    # (they end up at the front of output)
+    input_bits = b''.join(map(BYTE_BITS.__getitem__, reversed(input_str.encode('ascii')))) + bytes(config[0])
+    # get table of encoder outputs from config - it pays off only when encoder visits
+    # at least as many buffer values as the table has, otherwise outputs are calculated in every step
+    mask_y, mask_z = getIndexes(config)
+    out_table = getOutputTable(config) if (1 << (config[0] + 1)) <= len(input_bits) else None
+    # result buffer initialization - ASCII digits are written from the back, 2 per input bit
+    write_pos = 2 * len(input_bits)
+    res = bytearray(write_pos)
     
     # simulates shifting register and computes output into `res` buffer
-    for branch in input_bin[::-1]:
-        res = calculateOutput(branch, state, indexes_y, indexes_z, res)
-        state.pop()
-        state.insert(0, branch)
+    for branch in input_bits:
+        buffer_int = (branch << config[0]) | state
+        out = out_table[buffer_int] if out_table != None else calculateOutput(branch, state, config[0], mask_y, mask_z)
+        write_pos -= 2
+        res[write_pos] = 0x30 + (out >> 1)
+        res[write_pos + 1] = 0x30 + (out & 1)
+        # shift encoder buffer - the oldest cell falls out
+        state = buffer_int >> 1
 
-    return list(map(str, res))
+    return res.decode('ascii')
 
 
 def getIndexes(config):
     """
-        Compute indexes for feedback schemes.
+        Compute masks for feedback schemes.
 
         Parameters
         ----------
@@ -103,22 +137,38 @@ def getIndexes(config):
         Returns
         ----------
         Two values where:
-            1st value is a list of indexes for upper scheme
-            2nd value is a list of indexes for lower scheme
+            1st value is a bitmask of encoder buffer connections for upper scheme
+            2nd value is a bitmask of encoder buffer connections for lower scheme
     """
 
     # get required number of bits from Y and Z values to match size of encoder buffer
-    conf_y = (['0' for x in range(config[0])] + list(bin(config[1]).replace('b','')))[(-(config[0]+1)):]
-    conf_z = (['0' for x in range(config[0])] + list(bin(config[2]).replace('b','')))[(-(config[0]+1)):]
+    buffer_mask = (1 << (config[0] + 1)) - 1
+    mask_y = config[1] & buffer_mask
+    mask_z = config[2] & buffer_mask
     
-    # save indexes to lists
-    indexes_y = [idx for idx, val in enumerate(conf_y) if val == '1']
-    indexes_z = [idx for idx, val in enumerate(conf_z) if val == '1']
-    
-    return indexes_y, indexes_z
+    return mask_y, mask_z
+
+
+def getOutputTable(config):
+    """
+        Compute lookup table of encoder outputs for every encoder buffer value.
+
+        Parameters
+        ----------
+        config : [X,Y,Z]
+        
+        Returns
+        ----------
+        Bytes of length 2^(X+1) where item at index `(branch << X) | state` is the 2-bit encoder output
+    """
+
+    mask_y, mask_z = getIndexes(config)
+    state_mask = (1 << config[0]) - 1
+
+    return bytes(calculateOutput(buffer_int >> config[0], buffer_int & state_mask, config[0], mask_y, mask_z) for buffer_int in range(1 << (config[0] + 1)))
 
 
-def calculateOutput(branch, state, indexes_y, indexes_z, res):
+def calculateOutput(branch, state, x, mask_y, mask_z):
     """
         Calculate encoder output for given branch, state and schemes.
 
@@ -127,52 +177,39 @@ def calculateOutput(branch, state, indexes_y, indexes_z, res):
         branch : int, [0,1]
             MSB bit of encoder buffer
 
-        state : list of [0,1]
-            State of encoder buffer (delay cells)
+        state : int
+            State of encoder buffer (delay cells) as X-bit mask
 
-        indexes_y : list of int
-            Upper scheme indexes
-        
-        indexes_z : list of int
-            Lower scheme indexes
+        x : int
+            Number of delay cells
 
-        res : list of [0,1]
-            Result output buffer
+        mask_y : int
+            Upper scheme mask
+        
+        mask_z : int
+            Lower scheme mask
         
         Returns
         ----------
-        Modified `res` buffer with new 2-bit encoder output at the front
+        2-bit encoder output as int (upper scheme output is MSB)
     """
     
     # create encoder buffer
-    buffer = [branch] + state
-
-    # get indexed values to temporary lists
-    tmp_y = []
-    tmp_z = []
+    buffer_int = (branch << x) | state
 
-    for idx in indexes_y:
-        tmp_y.append(buffer[idx])
+    # make xor operation over connected bits (parity of masked buffer)
+    res_y = bin(buffer_int & mask_y).count('1') & 1
+    res_z = bin(buffer_int & mask_z).count('1') & 1
 
-    for idx in indexes_z:
-        tmp_z.append(buffer[idx])
+    return (res_y << 1) | res_z
 
-    # make xor operation over temporary lists
-    res_y = reduce(lambda x, y: x ^ y, tmp_y)
-    res_z = reduce(lambda x, y: x ^ y, tmp_z)
 
-    # update result buffer
-    res.insert(0, res_z)
-    res.insert(0, res_y)
-
-    return res
-
-
-def decode(input_str, config=[5,53,46]):
+def decode(input_str, config=[5,53,46], beam=0, leniency=None):
     """
         Decode binary input using convolutional decoder with defined configuration.
 
         If the argument `config` isn't passed in, the default configuration is used.
+        If `beam` or `leniency` is passed in, trellis paths are pruned in every step (faster, but not exact).
 
         Parameters
         ----------
@@ -184,158 +221,397 @@ def decode(input_str, config=[5,53,46]):
                 X : int, number of delay cells (memory blocks)
                 Y : int, *upper feedback scheme
                 Z : int, *lower feedback scheme 
+
+        beam : int, optional
+            Maximal number of paths kept in every step (0 - disabled)
+
+        leniency : int, optional
+            Maximal difference of path error from the lowest error in every step (None - disabled)
         
         Returns
         ----------
-        Decoded input in form of list of chars.
+        Decoded input in form of string.
 
         * - ones define connection of specific index
     """
 
-    # initialize state with given X value from config
-    state = [0 for x in range(config[0])]
-    # parse input binary string into pair tuples
-    input_tuples = list(zip(input_str[::2], input_str[1::2]))
-    # create list of pairs from pair tuples
-    input_pairs = list(''.join(pair) for pair in input_tuples)
-    # get scheme indexes from config
-    indexes_y, indexes_z = getIndexes(config)
+    # parse input binary string into pairs of bits as 2-bit ints (incomplete last pair is ignored),
+    # input is processed from LSB pairs of bits
+    data = input_str.encode('ascii')[:len(input_str) & ~1]
+    # compiled/vectorized trellis traversal is used for exact decoding when possible,
+    # it pays off for its import time only with large trellis
+    kernel = None
+    if not beam and leniency == None and (len(data) // 2) << config[0] >= TRELLIS_MIN_CELLS:
+        kernel = loadTrellisKernel()
+
+    # find best path with the lowest error_count
+    if kernel != None:
+        pairs = np.frombuffer(data, dtype=np.uint8).reshape(-1, 2)[::-1] - 48
+        pair_ints = (pairs[:, 0] << 1) | pairs[:, 1]
+        best_path = decodeTrellis(pair_ints, getOutputTable(config), config[0], kernel)
+    else:
+        pair_ints = bytes(((high - 48) << 1) | (low - 48) for high, low in zip(data[-2::-2], data[::-2]))
+        best_path = decodePaths(pair_ints, config, beam, leniency)
+    
+    # drop X initialization bits (MSB side) and incomplete last byte (LSB side) from best path
+    res_len = max(best_path[PATH_LEN] - config[0], 0)
+    res_bits = (best_path[PATH] & ((1 << res_len) - 1)) >> (res_len % 8)
+    res_bin = res_bits.to_bytes(res_len // 8, 'big')
+    
+    # create string of corresponding chars for each byte from `res_bin`
+    # chars are limited by ASCII encoding
+    #   - every char with ASCII value > 127 is ignored on output
+    #   - printing ASCII value > 127 on merlin leads to errors (otherwise it works fine above 127 on other systems)
+    res = res_bin.translate(None, NON_ASCII_DELETE).decode('ascii')
+    
+    return res
+
+
+def decodePaths(pair_ints, config, beam=0, leniency=None):
+    """
+        Find best path through trellis by keeping list of surviving paths.
+
+        Parameters
+        ----------
+        pair_ints : bytes
+            Input pairs of bits as 2-bit ints in order of processing
+
+        config : [X,Y,Z]
+            Configuration of encoder
+
+        beam : int, optional
+            Maximal number of paths kept in every step (0 - disabled)
+
+        leniency : int, optional
+            Maximal difference of path error from the lowest error in every step (None - disabled)
+        
+        Returns
+        ----------
+        Path tuple (PATH, PATH_LEN, ERR_C, STATE) ending in state 0 (or with the lowest error_count if it was pruned).
+    """
 
     # initialize first path - structure to help simulate trellis traversal and memorize needed data
-    # path is defined by tuple (path, error_count, state) where:
-    #   path - decoded portion of input
+    # path is defined by tuple (path, path_length, error_count, state) where:
+    #   path - decoded portion of input as int (latest decoded bit is MSB)
+    #   path_length - number of decoded bits in path
     #   error_count - sum of Hamming distances of this path
     #   state - latest state of this path
     # paths are stored in list `paths`
-    paths = [('', 0, state)]
-
-    # process input from LSB pairs of bits
-    for pair in input_pairs[::-1]:
-        # create new paths by finding new possible states and calculate error for new states
-        new_paths = []
-        for path in paths:
-            new_paths += eval_step(path, indexes_y, indexes_z, pair)
-
-        # group new paths into lists according to state value
-        grouped_paths = []
-        for key, group in groupby(sorted(new_paths, key = lambda x: x[STATE]), key = lambda x: x[STATE]): 
-            grouped_paths.append(list(group))
-
-        # reduce paths - remove all paths with same state but higher error_count
-        reduced_paths = []
-        for item in grouped_paths:
-            reduced_paths.append(min(item, key = lambda t: t[ERR_C]))
+    paths = [(0, 0, 0, 0)]
+
+    x = config[0]
+    mask_y, mask_z = getIndexes(config)
+    # Hamming distances of all butterfly edges for every value of (expected output of even state ^ input pair)
+    butterfly_metrics = calculateButterflyMetrics(config)
+    # Hamming distances of edges of every butterfly (dict keyed by butterfly) for every input pair
+    # (only output of even state with branch 0 is needed, errors of other edges are derived from it)
+    #   - exact decoding visits all butterflies, so they are precomputed from table of encoder outputs
+    #   - pruned decoding visits only few of them, so they are calculated on first visit
+    if not beam and leniency == None:
+        out_table = getOutputTable(config)
+        edge_metrics = [{butterfly: butterfly_metrics[out_table[butterfly << 1] ^ pair_int] for butterfly in range(1 << (x - 1))} for pair_int in range(4)]
+    else:
+        edge_metrics = [{} for pair_int in range(4)]
+
+    for pair_int in pair_ints:
+        pair_metrics = edge_metrics[pair_int]
+
+        # pair surviving paths into butterflies - states 2k and 2k+1 share new states k (branch 0) and k+2^(X-1) (branch 1)
+        survivors = {path[STATE]: path for path in paths}
+        lower_paths = []
+        upper_paths = []
+        for butterfly in dict.fromkeys(path[STATE] >> 1 for path in paths):
+            metrics = pair_metrics.get(butterfly)
+            if metrics == None:
+                metrics = pair_metrics[butterfly] = butterfly_metrics[calculateOutput(0, butterfly << 1, x, mask_y, mask_z) ^ pair_int]
+            path_0, path_1 = eval_step(survivors.get(butterfly << 1), survivors.get((butterfly << 1) | 1), x, metrics)
+            lower_paths.append(path_0)
+            upper_paths.append(path_1)
         
-        # update `paths` with relevant paths
-        paths = reduced_paths.copy()
+        # update `paths` with relevant paths (ordered by state to keep ties resolved towards lower states)
+        lower_paths += upper_paths
+        paths = lower_paths
 
-    # find best path with the lowest error_count
+        # prune paths with error_count too far from the lowest one
+        if leniency != None:
+            min_err = min(path[ERR_C] for path in paths)
+            paths = [path for path in paths if path[ERR_C] <= min_err + leniency]
+
+        # prune paths - keep only `beam` paths with the lowest error_count
+        if beam and len(paths) > beam:
+            paths = sorted(heapq.nsmallest(beam, paths, key = lambda t: t[ERR_C]), key = lambda t: t[STATE])
+
+    # encoder ends in state 0 after X initialization bits, so path with state 0 is the best one
+    # (`paths` are ordered by state) - it can be missing only if it was pruned
+    if paths[0][STATE] == 0:
+        return paths[0]
+
+    # otherwise find best path with the lowest error_count
     min_err = sys.maxsize
     best_path = ()
     for path in paths:
         if path[ERR_C] < min_err:
             best_path = path
             min_err = path[ERR_C]
-    
-    # segment best path into list of 8-bit values
-    res_bin = re.findall('........', best_path[PATH][config[0]:])
-    
-    # create list of corresponding chars for each element from `res_bin`
-    # chars are limited by ASCII encoding
-    #   - every char with ASCII value > 127 is ignored on output
-    #   - printing ASCII value > 127 on merlin leads to errors (otherwise it works fine above 127 on other systems)
-    res = map(lambda x: chr(int(x,2)) if int(x,2) < 128 else '', res_bin)
-    
-    return res
+
+    return best_path
 
 
-def eval_step(path, indexes_y, indexes_z, pair):
+def decodeTrellis(pair_ints, out_table, x, kernel):
     """
-        Evaluate trellis step. Take `path` and calculate all possible new states with error.
+        Find best path through trellis by keeping arrays of errors for all states
+        and tracing back decisions of compiled or vectorized trellis traversal.
 
         Parameters
         ----------
-        path : (PATH, ERR_C, STATE)
-            Path tuple where:
-                PATH : string, decoded part of input
-                ERR_C : int, sum of Hamming distances of this path
-                STATE : list of int, latest state of this path
-        
-        indexes_y : list of int
-            Upper scheme indexes
+        pair_ints : array of uint8
+            Input pairs of bits as 2-bit ints in order of processing
+
+        out_table : bytes
+            Table of encoder outputs (see `getOutputTable`)
+
+        x : int
+            Number of delay cells
+
+        kernel : function
+            Trellis traversal function (see `loadTrellisKernel`)
         
-        indexes_z : list of int
-            Lower scheme indexes
+        Returns
+        ----------
+        Path tuple (PATH, PATH_LEN, ERR_C, STATE) ending in state 0.
+    """
+
+    # Hamming distances of every trellis edge (indexed as `out_table`) for every possible input pair
+    outputs = np.frombuffer(out_table, dtype=np.uint8)
+    popcount = np.array([0, 1, 1, 2], dtype=np.uint8)
+    metrics = popcount[outputs ^ np.arange(4, dtype=np.uint8)[:, np.newaxis]]
+
+    # errors of paths ending in each state, only initial state 0 is reachable at the beginning
+    err = np.full(1 << x, ERR_INF, dtype=np.int32)
+    err[0] = 0
+    err_new = np.empty_like(err)
+    # chosen predecessor (0 - even, 1 - odd) of each state in each step
+    decisions = np.empty((len(pair_ints), 1 << x), dtype=np.uint8)
+
+    # both predecessors (2k and 2k+1) of every state and trellis edges from them, same for every step
+    states = np.arange(1 << x)
+    predecessors = ((states << 1) & ((1 << x) - 1)) | np.arange(2)[:, np.newaxis]
+    edges = ((states >> (x - 1)) << x) | predecessors
+
+    err = kernel(err, err_new, decisions, metrics, pair_ints, predecessors, edges)
+
+    # trace back decisions from state 0 - encoder ends in it after X initialization bits (latest decoded bit first)
+    #   - decoded bit of each step is packed directly at its position in path int
+    path_len = len(pair_ints)
+    path_bits = np.zeros(path_len, dtype=np.uint8)
+    cur_state = 0
+    for step in range(path_len - 1, -1, -1):
+        path_bits[step] = cur_state >> (x - 1)
+        cur_state = ((cur_state << 1) & ((1 << x) - 1)) | int(decisions[step, cur_state])
+    path = int.from_bytes(np.packbits(path_bits, bitorder='little').tobytes(), 'little')
+
+    return (path, path_len, int(err[0]), 0)
+
+
+def viterbiStep(err, err_new, decisions, metrics, predecessors, edges):
+    """
+        Evaluate trellis step for all states. Every new state keeps the better of its two predecessors
+        (2k and 2k+1 where k is new state without its MSB).
+
+        Parameters
+        ----------
+        err : array of int32
+            Errors of paths ending in each state
+
+        err_new : array of int32
+            Output buffer for errors of paths ending in each new state
+
+        decisions : array of uint8
+            Output buffer for chosen predecessor of each new state (0 - even, 1 - odd)
+
+        metrics : array of uint8
+            Hamming distances of input pair to every trellis edge (indexed as `out_table`)
+
+        predecessors : 2D array of int
+            Even (row 0) and odd (row 1) predecessor of every state
+
+        edges : 2D array of int
+            Trellis edges (indexed as `out_table`) from even (row 0) and odd (row 1) predecessor of every state
+    """
+
+    for state in range(err.shape[0]):
+        err_a = err[predecessors[0, state]] + metrics[edges[0, state]]
+        err_b = err[predecessors[1, state]] + metrics[edges[1, state]]
+        if err_a <= err_b:
+            err_new[state] = err_a
+            decisions[state] = 0
+        else:
+            err_new[state] = err_b
+            decisions[state] = 1
+
+
+def viterbiStepVectorized(err, err_new, decisions, metrics, predecessors, edges):
+    """
+        Evaluate trellis step for all states using numpy array operations (same as `viterbiStep`).
+
+        Parameters
+        ----------
+        See `viterbiStep`.
+    """
+
+    err_a = err[predecessors[0]] + metrics[edges[0]]
+    err_b = err[predecessors[1]] + metrics[edges[1]]
+
+    np.greater(err_a, err_b, out=decisions)
+    np.minimum(err_a, err_b, out=err_new)
+
+
+def viterbiTrellis(err, err_new, decisions, metrics, pair_ints, predecessors, edges):
+    """
+        Traverse trellis - evaluate `viterbi_step` for every input pair.
+
+        Parameters
+        ----------
+        err : array of int32
+            Errors of paths ending in each state before the first step
+
+        err_new : array of int32
+            Buffer for errors of paths (same shape as `err`)
 
-        pair : str
-            Pair of bits from input
+        decisions : 2D array of uint8
+            Output buffer for chosen predecessors of each state in each step
+
+        metrics : 2D array of uint8
+            Hamming distances of every trellis edge (indexed as `out_table`) for every possible input pair
+
+        pair_ints : array of uint8
+            Input pairs of bits as 2-bit ints in order of processing
+
+        predecessors : 2D array of int
+            Predecessors of every state (see `viterbiStep`)
+
+        edges : 2D array of int
+            Trellis edges from predecessors of every state (see `viterbiStep`)
         
         Returns
         ----------
-        List of new possible paths.
+        Errors of paths ending in each state after the last step.
     """
 
-    res = []
+    for i in range(pair_ints.shape[0]):
+        viterbi_step(err, err_new, decisions[i], metrics[pair_ints[i]], predecessors, edges)
+        err, err_new = err_new, err
 
-    # create new states from latest state
-    state_a = path[STATE].copy()
-    state_b = path[STATE].copy()
+    return err
 
-    state_a.pop()
-    state_b.pop()
 
-    state_a.insert(0, 0)
-    state_b.insert(0, 1)
+# trellis step and traversal functions, selected on first exact decoding of large trellis (see `loadTrellisKernel`)
+viterbi_step = None
+trellis_kernel = None
+# numpy isn't available, trellis traversal can't be used
+trellis_unavailable = False
 
-    # calculate error of step to new state (Hamming distance)
-    err_a = 0
-    err_b = 0
-    err_a = calculateHammingDist(0, path[STATE], indexes_y, indexes_z, pair)
-    err_b = calculateHammingDist(1, path[STATE], indexes_y, indexes_z, pair)
 
-    # create new paths from new states and errors
-    res.append(('0' + path[PATH], path[ERR_C] + err_a, state_a))
-    res.append(('1' + path[PATH], path[ERR_C] + err_b, state_b))
+def loadTrellisKernel():
+    """
+        Import numpy and numba on first use (encoding and other decoding don't pay for it) and select trellis kernel.
+        Whole traversal is compiled when numba is available, steps are vectorized when only numpy is available.
 
-    return res
+        Returns
+        ----------
+        Trellis traversal function or None if numpy isn't available
+        (surviving paths are kept in pure Python then).
+    """
 
+    global np, viterbi_step, trellis_kernel, trellis_unavailable
 
-def calculateHammingDist(branch, state, indexes_y, indexes_z, pair):
+    if trellis_kernel == None and not trellis_unavailable:
+        try:
+            import numpy as np
+        except ImportError:
+            trellis_unavailable = True
+            return None
+
+        try:
+            from numba import njit
+        except ImportError:
+            viterbi_step = viterbiStepVectorized
+            trellis_kernel = viterbiTrellis
+        else:
+            # `viterbi_step` has to be compiled before `viterbiTrellis` (it is resolved as global on compilation)
+            viterbi_step = njit(cache=True)(viterbiStep)
+            trellis_kernel = njit(cache=True)(viterbiTrellis)
+
+    return trellis_kernel
+
+
+def eval_step(path_a, path_b, x, metrics):
     """
-        Calculate Hamming distance.
+        Evaluate trellis butterfly. Take paths with states 2k and 2k+1, calculate both their common new states
+        and keep only the path with the lowest error for each of them.
 
         Parameters
         ----------
-        branch : int, [0,1]
-            MSB bit of encoder buffer
+        path_a : (PATH, PATH_LEN, ERR_C, STATE) or None
+            Path tuple with even state (None if there is no such path) where:
+                PATH : int, decoded part of input (latest decoded bit is MSB)
+                PATH_LEN : int, number of decoded bits in PATH
+                ERR_C : int, sum of Hamming distances of this path
+                STATE : int, latest state of this path as X-bit mask
+
+        path_b : (PATH, PATH_LEN, ERR_C, STATE) or None
+            Path tuple with odd state (None if there is no such path)
 
-        state : list of [0,1]
-            State of encoder buffer (delay cells)
+        x : int
+            Number of delay cells
         
-        indexes_y : list of int
-            Upper scheme indexes
+        metrics : (int, int, int, int)
+            Hamming distances of butterfly edges (see `calculateButterflyMetrics`)
         
-        indexes_z : list of int
-            Lower scheme indexes
+        Returns
+        ----------
+        Two new paths - for branch 0 and branch 1.
+    """
+
+    res = []
+
+    for branch in range(2):
+        # calculate error of step to new state from both paths (Hamming distance)
+        err_a = path_a[ERR_C] + metrics[branch << 1] if path_a else ERR_INF
+        err_b = path_b[ERR_C] + metrics[(branch << 1) | 1] if path_b else ERR_INF
+        path, err = (path_a, err_a) if err_a <= err_b else (path_b, err_b)
+
+        # create new path from better path, new state and error
+        res.append(((branch << path[PATH_LEN]) | path[PATH], path[PATH_LEN] + 1, err, (path[STATE] >> 1) | (branch << (x - 1))))
+
+    return res
 
-        pair : str
-            Pair of bits from input
+
+def calculateButterflyMetrics(config):
+    """
+        Calculate Hamming distances of trellis butterfly edges.
+
+        Encoder is linear, so outputs of all four edges of butterfly (states 2k and 2k+1, branches 0 and 1)
+        differ from output of edge (2k, branch 0) only by constant values. Hamming distances of all edges
+        are therefore given by value of (output of edge (2k, branch 0) ^ input pair).
+
+        Parameters
+        ----------
+        config : [X,Y,Z]
         
         Returns
         ----------
-        Hamming distance/number of different bits.
+        List of 4 tuples indexed by (output of edge (2k, branch 0) ^ input pair) where each tuple contains
+        Hamming distances of edges (2k, branch 0), (2k+1, branch 0), (2k, branch 1), (2k+1, branch 1).
     """
-    
-    # simulate encoder step to find out expected encoder output for new state
-    res = []
-    res = calculateOutput(branch, state, indexes_y, indexes_z, res)
 
-    # calculate Hamming distance between input pair and expected pair
-    expected_val = int(''.join(map(str, res)), 2)
-    input_val = int(pair, 2)
-    dist = str(bin(expected_val ^ input_val)).count('1')
+    # output differences caused by the oldest delay cell and by the branch
+    mask_y, mask_z = getIndexes(config)
+    diff_state = calculateOutput(0, 1, config[0], mask_y, mask_z)
+    diff_branch = calculateOutput(1, 0, config[0], mask_y, mask_z)
+    diffs = (0, diff_state, diff_branch, diff_state ^ diff_branch)
 
-    return dist
+    return [tuple(bin(val ^ diff).count('1') for diff in diffs) for val in range(4)]
     
 
 if __name__ == "__main__":